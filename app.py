@@ -1,13 +1,23 @@
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
 import base64
+import hashlib
+import os
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 import re
 import json
+from collections import Counter, defaultdict
 from datetime import datetime, date
-from PIL import Image
+from PIL import Image, ImageOps, UnidentifiedImageError
 from io import BytesIO
 import pandas as pd
-from difflib import SequenceMatcher
+from rapidfuzz import fuzz, process
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 # ------------------------------
 # 1. 页面配置
@@ -25,13 +35,62 @@ FEISHU_APP_SECRET = st.secrets["FEISHU_APP_SECRET"]
 FEISHU_APP_TOKEN = st.secrets["FEISHU_APP_TOKEN"]
 FEISHU_TABLE_ID = st.secrets["FEISHU_TABLE_ID"]
 FEISHU_MEMBER_TABLE_ID = st.secrets.get("FEISHU_MEMBER_TABLE_ID", None)  # 可选
+FEISHU_RECORD_TABLE_ID = st.secrets.get("FEISHU_RECORD_TABLE_ID", None)  # 可选，通过的打卡记录同步到此表
 
 # 相似度阈值（0.75 表示75%相似即通过）
 THRESHOLD = 0.75
 
+# 并发OCR的最大线程数（受百度QPS限制，可通过环境变量调整）
+OCR_CONCURRENCY = int(os.environ.get("OCR_CONCURRENCY", 8))
+
+# ------------------------------
+# 带指数退避的HTTP请求（限流/临时故障自动重试）
+# ------------------------------
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+BAIDU_RETRY_ERROR_CODES = (18,)  # QPS超限；17/19为日/总配额用尽，重试无意义
+HTTP_TIMEOUT = (5, 30)  # (连接, 读取) 超时秒数，避免连接卡死阻塞页面
+
+# 复用同一个 Session 的连接池，省去每次请求的 TCP/TLS 握手
+@st.cache_resource
+def get_http_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=16, pool_maxsize=16, max_retries=0)
+    session.mount("https://", adapter)
+    return session
+
+def _request_with_retry(method, url, *, max_attempts=3, base=0.5, cap=8, **kwargs):
+    session = get_http_session()
+    kwargs.setdefault("timeout", HTTP_TIMEOUT)
+    for attempt in range(max_attempts):
+        last_attempt = attempt == max_attempts - 1
+        try:
+            resp = session.request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            if last_attempt:
+                raise
+        else:
+            retryable = resp.status_code in RETRY_STATUS_CODES
+            if not retryable and resp.ok:
+                try:
+                    retryable = resp.json().get("error_code") in BAIDU_RETRY_ERROR_CODES
+                except ValueError:
+                    pass
+            if not retryable or last_attempt:
+                return resp
+        time.sleep(min(cap, base * 2 ** attempt) + random.uniform(0, 0.2))
+
 # ------------------------------
-# 3. 百度OCR获取access_token
+# 3. 百度OCR获取access_token（有效期约30天，缓存25天）
 # ------------------------------
+BAIDU_TOKEN_INVALID_CODES = (110, 111)  # access_token 无效 / 过期
+
+# 注：下面被 st.cache_* 缓存的函数失败时一律抛出异常而不是返回空值，
+# Streamlit 不会缓存抛出异常的调用，失败结果因此不会被记住
+
+class BaiduTokenError(Exception):
+    """获取百度 access_token 失败"""
+
+@st.cache_resource(ttl=25 * 24 * 3600, show_spinner=False)
 def get_baidu_access_token():
     url = "https://aip.baidubce.com/oauth/2.0/token"
     params = {
@@ -39,63 +98,160 @@ def get_baidu_access_token():
         "client_id": BAIDU_API_KEY,
         "client_secret": BAIDU_SECRET_KEY
     }
-    res = requests.post(url, params=params)
-    return res.json().get("access_token")
+    res = _request_with_retry("POST", url, params=params)
+    result = res.json()
+    token = result.get("access_token")
+    if not token:
+        raise BaiduTokenError(f"获取百度 access_token 失败：{result}")
+    return token
 
 # ------------------------------
 # 4. 调用百度通用文字识别（标准版）
 # ------------------------------
+# 大图先压缩再上传：短边缩到1600px以内并转为JPEG
+OCR_MAX_SHORT_SIDE = 1600
+OCR_SHRINK_MIN_BYTES = 500_000
+
+def shrink_image(image_bytes):
+    if len(image_bytes) < OCR_SHRINK_MIN_BYTES:
+        return image_bytes
+    try:
+        img = Image.open(BytesIO(image_bytes))
+        # 重新编码会丢掉 EXIF，先按方向信息把照片转正
+        img = ImageOps.exif_transpose(img)
+        # 按短边缩放，长截图不会被压成一条窄条
+        scale = OCR_MAX_SHORT_SIDE / min(img.size)
+        if scale < 1:
+            img = img.resize((round(img.width * scale), round(img.height * scale)), Image.LANCZOS)
+        buf = BytesIO()
+        img.convert("RGB").save(buf, format="JPEG", quality=85, optimize=True)
+    except (UnidentifiedImageError, OSError):
+        # Pillow 无法解码时原样上传，由OCR结果决定是否报错
+        return image_bytes
+    shrunk = buf.getvalue()
+    return shrunk if len(shrunk) < len(image_bytes) else image_bytes
+
 def baidu_ocr(image_bytes):
-    token = get_baidu_access_token()
-    url = f"https://aip.baidubce.com/rest/2.0/ocr/v1/general_basic?access_token={token}"
+    image_bytes = shrink_image(image_bytes)
     headers = {"Content-Type": "application/x-www-form-urlencoded"}
-    img_base64 = base64.b64encode(image_bytes).decode()
-    data = {"image": img_base64}
-    resp = requests.post(url, headers=headers, data=data)
-    result = resp.json()
+    # 直接拼出表单请求体：base64 中只有 + / = 需要转义，
+    # 比 requests 内部逐字节的 urlencode 快一个数量级
+    img_base64 = base64.b64encode(image_bytes)
+    data = b"image=" + img_base64.replace(b"+", b"%2B").replace(b"/", b"%2F").replace(b"=", b"%3D")
+    for _ in range(2):
+        try:
+            token = get_baidu_access_token()
+        except (BaiduTokenError, requests.RequestException) as e:
+            st.error(f"OCR识别失败：{e}")
+            return []
+        url = f"https://aip.baidubce.com/rest/2.0/ocr/v1/general_basic?access_token={token}"
+        try:
+            resp = _request_with_retry("POST", url, headers=headers, data=data)
+            result = resp.json()
+        except requests.RequestException as e:
+            # 包括重试后仍返回非JSON错误页（JSONDecodeError）的情况
+            st.error(f"OCR请求失败：{e}")
+            return []
+        # 缓存的 token 失效时清除缓存，重新获取后再试一次
+        if result.get("error_code") not in BAIDU_TOKEN_INVALID_CODES:
+            break
+        get_baidu_access_token.clear()
     if "words_result" in result:
         return [item["words"] for item in result["words_result"]]
     else:
         st.error(f"OCR识别失败：{result}")
         return []
 
+class OCRFailed(Exception):
+    """OCR未返回任何文字"""
+
+# 按图片内容哈希缓存识别结果，重复上传/页面重跑不再重复调用OCR
+# （_image_bytes 以下划线开头，Streamlit 不对其求哈希）
+@st.cache_data(ttl=86400, max_entries=500, show_spinner=False)
+def cached_baidu_ocr(image_hash, _image_bytes):
+    text_lines = baidu_ocr(_image_bytes)
+    if not text_lines:
+        raise OCRFailed(image_hash)
+    return text_lines
+
+def baidu_ocr_many(images):
+    """
+    并发识别多张图片
+    输入：(图片哈希, 图片字节) 列表
+    输出：与输入顺序一致的文本行列表
+    """
+    # 先在主线程取好 token，避免多个线程同时去请求（失败时由各线程分别报错）
+    try:
+        get_baidu_access_token()
+    except (BaiduTokenError, requests.RequestException):
+        pass
+    ctx = get_script_run_ctx()
+
+    def _worker(image):
+        # 让工作线程里的 st.error 能正常显示到页面
+        add_script_run_ctx(threading.current_thread(), ctx)
+        image_hash, image_bytes = image
+        try:
+            return cached_baidu_ocr(image_hash, image_bytes)
+        except OCRFailed:
+            return []
+        except Exception as e:
+            # 单张图片的意外错误只影响这一张，不让 pool.map 把整批结果丢掉
+            st.error(f"OCR识别出错：{e}")
+            return []
+
+    with ThreadPoolExecutor(max_workers=max(1, min(OCR_CONCURRENCY, len(images)))) as pool:
+        return list(pool.map(_worker, images))
+
 # ------------------------------
 # 5. 从飞书多维表格获取今日论文摘要
 # ------------------------------
-def get_feishu_access_token():
+class FeishuError(Exception):
+    """飞书接口返回错误"""
+
+# tenant_access_token 有效期约2小时，按接口返回的 expire 在过期前5分钟刷新
+FEISHU_TOKEN_REFRESH_MARGIN = 300
+
+@st.cache_resource(show_spinner=False)
+def _fetch_feishu_access_token():
     url = "https://open.feishu.cn/open-apis/auth/v3/tenant_access_token/internal"
     headers = {"Content-Type": "application/json; charset=utf-8"}
     payload = {
         "app_id": FEISHU_APP_ID,
         "app_secret": FEISHU_APP_SECRET
     }
-    res = requests.post(url, headers=headers, json=payload)
-    return res.json().get("tenant_access_token")
+    res = _request_with_retry("POST", url, headers=headers, json=payload)
+    result = res.json()
+    token = result.get("tenant_access_token")
+    if not token:
+        raise FeishuError(f"获取飞书 tenant_access_token 失败：{result.get('msg', result)}")
+    return token, time.time() + result.get("expire", 0)
 
-def fetch_today_abstract():
+def get_feishu_access_token():
+    token, expires_at = _fetch_feishu_access_token()
+    # 剩余不足30分钟时飞书才会下发新 token，提前5分钟刷新即可拿到新的
+    if time.time() >= expires_at - FEISHU_TOKEN_REFRESH_MARGIN:
+        _fetch_feishu_access_token.clear()
+        token, _ = _fetch_feishu_access_token()
+    return token
+
+# 以日期为参数缓存，跨天后自动重新拉取
+@st.cache_data(ttl=3600, show_spinner=False)
+def fetch_today_abstract(today_str):
     token = get_feishu_access_token()
     headers = {
         "Authorization": f"Bearer {token}",
         "Content-Type": "application/json; charset=utf-8"
     }
-    # 筛选：发布日期 = 今天
-    today_str = date.today().strftime("%Y-%m-%d")
-    # 注意：飞书多维表格日期字段过滤语法为 '字段名 = "值"'
-    # 这里简单查询前10条，取发布日期匹配今天的；若没有则取最新一条
+    # 服务端按发布日期过滤，只返回当天那一条
     url = f"https://open.feishu.cn/open-apis/bitable/v1/apps/{FEISHU_APP_TOKEN}/tables/{FEISHU_TABLE_ID}/records"
-    params = {"page_size": 10}
-    resp = requests.get(url, headers=headers, params=params)
-    records = resp.json().get("data", {}).get("items", [])
-    
-    for rec in records:
-        fields = rec.get("fields", {})
-        pub_date = fields.get("发布日期")
-        if pub_date:
-            # 飞书返回日期格式可能为 "2026-02-13"
-            if pub_date.startswith(today_str):
-                abstract = fields.get("论文摘要", "")
-                return abstract.strip()
-    # 没找到当天的，取第一条（假设管理员已录入）
+    params = {"filter": f'CurrentValue.[发布日期]="{today_str}"', "page_size": 1}
+    resp = _request_with_retry("GET", url, headers=headers, params=params)
+    result = resp.json()
+    if result.get("code") != 0:
+        raise FeishuError(f"拉取今日摘要失败：{result.get('msg', result)}")
+    records = (result.get("data") or {}).get("items") or []
+    # 当天未录入时返回空，由页面提示管理员补录
     if records:
         fields = records[0].get("fields", {})
         return fields.get("论文摘要", "").strip()
@@ -104,61 +260,121 @@ def fetch_today_abstract():
 # ------------------------------
 # 6. 从OCR文本中解析打卡信息（适配你的小红书模版）
 # ------------------------------
+# 一次匹配一个三行打卡块：昵称行 / 打卡时间行 / 摘要句子行（句子前缀可选）
+_ENTRY_RE = re.compile(
+    r'^昵称[^\n]*?[:：][^\S\n]*(?P<nick>[^\n]*)\n'
+    r'打卡时间[^\n]*?[:：][^\S\n]*(?P<time>\d{4}/\d{1,2}/\d{1,2})[^\n]*\n'
+    r'(?:论文(?:原文)?摘要的随机一句话[^\n]*?[:：])?(?P<sent>[^\n]*)',
+    re.MULTILINE)
+
 def parse_checkin(text_lines):
     """
     输入：OCR识别的文本行列表
     输出：列表，每个元素为 (昵称, 打卡时间, 摘录句子)
     """
-    entries = []
-    i = 0
-    while i < len(text_lines):
-        line = text_lines[i].strip()
-        # 匹配昵称行：格式如 "昵称（仅中文/英文/数字且最好不要重名）：张三"
-        nick_match = re.match(r'^昵称.*?[:：]\s*(.*?)$', line)
-        if nick_match:
-            nickname = nick_match.group(1).strip()
-            # 检查下一行是否是打卡时间
-            if i+1 < len(text_lines):
-                time_line = text_lines[i+1].strip()
-                time_match = re.match(r'^打卡时间.*?[:：]\s*(\d{4}/\d{1,2}/\d{1,2})', time_line)
-                if time_match:
-                    punch_time = time_match.group(1).strip()
-                    # 再下一行是摘要句子
-                    if i+2 < len(text_lines):
-                        abstract_line = text_lines[i+2].strip()
-                        # 去除可能的前缀
-                        abstract_sentence = re.sub(r'^论文(原文)?摘要的随机一句话.*?[:：]', '', abstract_line).strip()
-                        entries.append((nickname, punch_time, abstract_sentence))
-                        i += 3
-                        continue
-        i += 1
-    return entries
+    # 去掉空行后拼成一段文本，用一个正则顺序扫描出全部打卡块
+    # 昵称行格式如 "昵称（仅中文/英文/数字且最好不要重名）：张三"
+    text = "\n".join(line.strip() for line in text_lines if line.strip())
+    return [(m["nick"].strip(), m["time"], m["sent"].strip()) for m in _ENTRY_RE.finditer(text)]
 
 # ------------------------------
 # 7. 相似度计算（简单文本匹配）
 # ------------------------------
-def similarity(a, b):
-    return SequenceMatcher(None, a, b).ratio()
+def batch_similarity(sentences, abstract):
+    """
+    一次性计算多条摘录句子与标准摘要的相似度（0~1）
+    使用 rapidfuzz 的 fuzz.ratio（归一化 Indel 相似度），cdist 在C++中批量计算
+    注意：它与 SequenceMatcher.ratio() 并不相同，后者对200字以上的文本启用 autojunk，
+    得分通常偏低；换用后同一句子的得分可能更高，THRESHOLD 下的通过率可能上升
+    """
+    if not sentences:
+        return []
+    scores = process.cdist(sentences, [abstract], scorer=fuzz.ratio)
+    return scores.ravel() / 100
 
 # ------------------------------
 # 8. 从飞书获取成员昵称列表（用于模糊匹配）
 # ------------------------------
+@st.cache_data(ttl=600, show_spinner=False)
 def fetch_member_nicknames():
     if not FEISHU_MEMBER_TABLE_ID:
         return []
     token = get_feishu_access_token()
     headers = {"Authorization": f"Bearer {token}"}
     url = f"https://open.feishu.cn/open-apis/bitable/v1/apps/{FEISHU_APP_TOKEN}/tables/{FEISHU_MEMBER_TABLE_ID}/records"
-    resp = requests.get(url, headers=headers)
-    records = resp.json().get("data", {}).get("items", [])
+    params = {"page_size": 500}
     nicknames = []
-    for rec in records:
-        fields = rec.get("fields", {})
-        nick = fields.get("昵称", "")
-        if nick:
-            nicknames.append(nick.strip())
+    # 按 page_token 翻页，直到取完全部成员
+    while True:
+        resp = _request_with_retry("GET", url, headers=headers, params=params)
+        result = resp.json()
+        if result.get("code") != 0:
+            raise FeishuError(f"拉取成员列表失败：{result.get('msg', result)}")
+        data = result.get("data") or {}
+        for rec in data.get("items") or []:
+            fields = rec.get("fields", {})
+            nick = fields.get("昵称", "")
+            if nick:
+                nicknames.append(nick.strip())
+        if not data.get("has_more") or not data.get("page_token"):
+            break
+        params["page_token"] = data["page_token"]
     return nicknames
 
+def build_member_index(member_nicknames):
+    """
+    构建成员昵称索引：(昵称集合, 用换行拼接的全部昵称)
+    """
+    member_set = {m.strip() for m in member_nicknames if m.strip()}
+    return member_set, "\n".join(member_set)
+
+def is_member(nickname, member_index):
+    """
+    昵称与某个成员昵称互相包含即视为有效
+    集合查找只与昵称长度有关；“昵称是成员昵称子串”一步仍需在拼接串上做一次C层面的线性查找
+    """
+    member_set, member_text = member_index
+    if nickname in member_set:
+        return True
+    # 昵称是某个成员昵称的子串（昵称本身不含换行，不会跨成员匹配）
+    if nickname in member_text:
+        return True
+    # 某个成员昵称是该昵称的子串：枚举昵称的所有子串查集合
+    n = len(nickname)
+    return any(nickname[i:j] in member_set for i in range(n) for j in range(i + 1, n + 1))
+
+# ------------------------------
+# 通过的打卡记录批量写回飞书（batch_create 每次最多500条）
+# ------------------------------
+FEISHU_BATCH_SIZE = 500
+FEISHU_SYNC_FIELDS = ("昵称", "打卡日期", "摘录句子", "相似度")
+
+def sync_records_to_feishu(records):
+    """
+    批量写入飞书，成功返回 None，失败返回错误信息
+    每批带一个 client_token，重试时飞书据此去重，不会重复插入
+    """
+    if not FEISHU_RECORD_TABLE_ID or not records:
+        return None
+    url = f"https://open.feishu.cn/open-apis/bitable/v1/apps/{FEISHU_APP_TOKEN}/tables/{FEISHU_RECORD_TABLE_ID}/records/batch_create"
+    try:
+        token = get_feishu_access_token()
+        headers = {
+            "Authorization": f"Bearer {token}",
+            "Content-Type": "application/json; charset=utf-8"
+        }
+        for i in range(0, len(records), FEISHU_BATCH_SIZE):
+            batch = records[i:i + FEISHU_BATCH_SIZE]
+            payload = {"records": [{"fields": {k: rec[k] for k in FEISHU_SYNC_FIELDS}} for rec in batch]}
+            params = {"client_token": str(uuid.uuid4())}
+            resp = _request_with_retry("POST", url, headers=headers, params=params, json=payload)
+            result = resp.json()
+            if result.get("code") != 0:
+                return f"打卡记录同步飞书失败：{result.get('msg', result)}"
+    except (FeishuError, requests.RequestException) as e:
+        return f"打卡记录同步飞书失败：{e}"
+    return None
+
 # ------------------------------
 # 9. 会话状态初始化（存储打卡记录）
 # ------------------------------
@@ -166,6 +382,32 @@ if "records" not in st.session_state:
     st.session_state.records = []  # 每条为 (昵称, 打卡日期, 摘要, 是否通过, 相似度)
 if "pending_review" not in st.session_state:
     st.session_state.pending_review = []  # 待复核（相似度低于阈值或昵称不匹配）
+if "nick_counter" not in st.session_state:
+    st.session_state.nick_counter = Counter()  # 昵称 -> 通过次数（增量维护，供排行榜使用）
+if "daily_counter" not in st.session_state:
+    st.session_state.daily_counter = defaultdict(Counter)  # 打卡日期 -> 昵称 -> 通过次数
+if "rank_dirty" not in st.session_state:
+    st.session_state.rank_dirty = True  # 有新的通过记录时置位，排行榜按需重建
+    st.session_state.rank_cached = None
+if "processed" not in st.session_state:
+    st.session_state.processed = set()  # 已核验过的图片哈希，页面重跑时不重复记录
+if "no_abstract_hashes" not in st.session_state:
+    st.session_state.no_abstract_hashes = set()  # 核验时尚未录入今日摘要的图片哈希，刷新飞书数据后允许重新核验
+if "uploader_key" not in st.session_state:
+    st.session_state.uploader_key = 0  # 清空记录时递增，使上传控件一并清空
+
+# 文本列使用 Arrow 字符串存储，比 object 列省内存
+RECORD_STRING_DTYPES = {"昵称": "string[pyarrow]", "打卡日期": "string[pyarrow]", "摘录句子": "string[pyarrow]"}
+
+def records_frame(records):
+    """把打卡记录列表转为 DataFrame（文本列为 pyarrow 字符串类型）"""
+    return pd.DataFrame(records).astype(RECORD_STRING_DTYPES)
+
+def count_passed_record(record):
+    """记录通过时增量更新排行榜计数"""
+    st.session_state.nick_counter[record["昵称"]] += 1
+    st.session_state.daily_counter[record["打卡日期"]][record["昵称"]] += 1
+    st.session_state.rank_dirty = True
 
 # ------------------------------
 # 10. 主界面：上传与核验
@@ -176,28 +418,57 @@ with col1:
     st.subheader("📤 上传打卡截图")
     uploaded_files = st.file_uploader("支持PNG/JPG，可多选（长截图建议拆分为单人或直接上传整张）",
                                       type=["png", "jpg", "jpeg"],
-                                      accept_multiple_files=True)
+                                      accept_multiple_files=True,
+                                      key=f"uploader_{st.session_state.uploader_key}")
     
+    # 获取当日标准摘要与成员列表；拉取失败时不做核验，避免整批被误判
+    feishu_ready = False
     if uploaded_files:
-        # 获取当日标准摘要
-        standard_abstract = fetch_today_abstract()
+        try:
+            standard_abstract = fetch_today_abstract(date.today().strftime("%Y-%m-%d"))
+            member_nicknames = fetch_member_nicknames()
+            feishu_ready = True
+        except (FeishuError, requests.RequestException) as e:
+            st.error(f"飞书数据拉取失败，请稍后重试：{e}")
+    
+    if feishu_ready:
         if not standard_abstract:
             st.warning("⚠️ 今日论文摘要未录入飞书多维表格，请管理员补录。")
         else:
             st.info(f"📄 今日论文摘要（前100字）：{standard_abstract[:100]}...")
         
-        member_nicknames = fetch_member_nicknames()
+        member_index = build_member_index(member_nicknames)
         
+        # 读取图片字节，跳过本会话已核验过的图片及本次重复选择的同一张图
+        new_files, images = [], []
+        seen = set()
         for uploaded_file in uploaded_files:
-            # 读取图片字节
-            image_bytes = uploaded_file.read()
-            # OCR识别
-            with st.spinner(f"正在识别 {uploaded_file.name} ..."):
-                text_lines = baidu_ocr(image_bytes)
-            
+            image_bytes = uploaded_file.getvalue()
+            image_hash = hashlib.sha256(image_bytes).hexdigest()
+            if image_hash in st.session_state.processed:
+                st.caption(f"{uploaded_file.name} 已核验过，跳过")
+                continue
+            if image_hash in seen:
+                st.caption(f"{uploaded_file.name} 与本次上传的其他图片内容相同，跳过")
+                continue
+            seen.add(image_hash)
+            new_files.append(uploaded_file)
+            images.append((image_hash, image_bytes))
+        
+        # 并发OCR识别
+        ocr_results = []
+        if images:
+            with st.spinner(f"正在识别 {len(images)} 张图片 ..."):
+                ocr_results = baidu_ocr_many(images)
+        
+        accepted = []  # 本次上传中通过的记录，最后一次性写回飞书
+        for uploaded_file, (image_hash, _), text_lines in zip(new_files, images, ocr_results):
             if not text_lines:
                 st.error(f"{uploaded_file.name} 识别失败，请检查图片是否清晰。")
                 continue
+            st.session_state.processed.add(image_hash)
+            if not standard_abstract:
+                st.session_state.no_abstract_hashes.add(image_hash)
             
             # 解析打卡条目
             entries = parse_checkin(text_lines)
@@ -207,56 +478,55 @@ with col1:
             
             st.success(f"{uploaded_file.name} 共识别出 {len(entries)} 条打卡记录")
             
-            # 逐条处理
-            for nickname, punch_time, sentence in entries:
-                # 日期有效性：必须是今天（可自定义）
-                is_date_valid = (punch_time == date.today().strftime("%Y/%m/%d"))
-                
-                # 相似度计算（如果标准摘要存在）
-                if standard_abstract:
-                    sim = similarity(sentence, standard_abstract)
-                    is_sim_pass = sim >= THRESHOLD
-                else:
-                    sim = 0.0
-                    is_sim_pass = False
-                
-                # 昵称有效性：若配置了成员表，检查是否在表中
-                nick_valid = True
-                if member_nicknames:
-                    # 简单包含匹配（可改为模糊匹配）
-                    if not any(nickname in m or m in nickname for m in member_nicknames):
-                        nick_valid = False
-                
-                # 整体是否通过（日期必须今天，相似度必须达标）
-                passed = is_date_valid and is_sim_pass and nick_valid
-                
-                # 记录
-                record = {
-                    "昵称": nickname,
-                    "打卡日期": punch_time,
-                    "摘录句子": sentence,
-                    "相似度": round(sim, 2),
-                    "日期有效": is_date_valid,
-                    "相似度达标": is_sim_pass,
-                    "昵称有效": nick_valid,
-                    "通过": passed
-                }
+            # 批量核验：日期、相似度、昵称按列计算
+            checked = pd.DataFrame(entries, columns=["昵称", "打卡日期", "摘录句子"])
+            # 日期有效性：必须是今天（可自定义）
+            checked["日期有效"] = checked["打卡日期"] == date.today().strftime("%Y/%m/%d")
+            # 相似度计算（如果标准摘要存在）：日期无效的条目必不通过，跳过计算记为0
+            checked["相似度"] = 0.0
+            date_valid = checked["日期有效"]
+            if standard_abstract and date_valid.any():
+                checked.loc[date_valid, "相似度"] = batch_similarity(
+                    checked.loc[date_valid, "摘录句子"].tolist(), standard_abstract)
+            checked["相似度达标"] = checked["相似度"] >= THRESHOLD
+            checked["相似度"] = checked["相似度"].round(2)
+            # 昵称有效性：若配置了成员表，检查是否在表中（简单包含匹配，可改为模糊匹配）
+            if member_nicknames:
+                checked["昵称有效"] = checked["昵称"].map(lambda nick: is_member(nick, member_index))
+            else:
+                checked["昵称有效"] = True
+            # 整体是否通过（日期必须今天，相似度必须达标）
+            checked["通过"] = checked["日期有效"] & checked["相似度达标"] & checked["昵称有效"]
+            
+            # 记录
+            columns = ["昵称", "打卡日期", "摘录句子", "相似度", "日期有效", "相似度达标", "昵称有效", "通过"]
+            for record in checked[columns].to_dict("records"):
                 st.session_state.records.append(record)
-                
-                if not passed:
+                if record["通过"]:
+                    count_passed_record(record)
+                    accepted.append(record)
+                else:
                     st.session_state.pending_review.append(record)
             
             # 显示本次识别结果
             df_temp = pd.DataFrame(entries, columns=["昵称", "打卡时间", "摘录句子"])
             st.dataframe(df_temp, use_container_width=True)
+        
+        # 同步到飞书：整批上传，一次请求最多500条
+        sync_error = sync_records_to_feishu(accepted)
+        if sync_error:
+            st.warning(sync_error)
 
 # ------------------------------
 # 11. 待复核面板（管理员手动修正）
 # ------------------------------
 with col2:
     st.subheader("🛠 待复核条目")
+    # 上一次强制通过时的同步失败信息（页面已重跑，需从会话状态中取出显示）
+    if "sync_error" in st.session_state:
+        st.warning(st.session_state.pop("sync_error"))
     if st.session_state.pending_review:
-        review_df = pd.DataFrame(st.session_state.pending_review)
+        review_df = records_frame(st.session_state.pending_review)
         st.dataframe(review_df)
         
         # 简单修正：一键强制通过（实际可设计下拉选择）
@@ -264,9 +534,13 @@ with col2:
             # 简化：全部强制通过（正式环境可加交互）
             for rec in st.session_state.pending_review:
                 rec["通过"] = True
+                count_passed_record(rec)
+            sync_error = sync_records_to_feishu(st.session_state.pending_review)
+            if sync_error:
+                st.session_state.sync_error = sync_error
             st.session_state.pending_review.clear()
             st.success("已强制通过所有待复核条目，请刷新页面查看排行榜。")
-            st.experimental_rerun()
+            st.rerun()
     else:
         st.info("当前无待复核条目")
 
@@ -276,37 +550,41 @@ with col2:
 st.markdown("---")
 st.subheader("🏆 打卡排行榜")
 
-if st.session_state.records:
-    df = pd.DataFrame(st.session_state.records)
-    # 仅统计通过的有效打卡
-    valid_df = df[df["通过"] == True]
-    
-    if not valid_df.empty:
-        # 按昵称分组计数
-        rank = valid_df.groupby("昵称").size().reset_index(name="打卡次数")
-        rank = rank.sort_values("打卡次数", ascending=False).reset_index(drop=True)
+# 排行榜作为独立 fragment，切换日期时只重跑这一块
+@st.fragment
+def render_leaderboard():
+    if st.session_state.records:
+        # 仅统计通过的有效打卡（计数在记录通过时已增量更新）
+        if st.session_state.nick_counter:
+            # 仅在有新的通过记录后重新排序，其余重跑直接复用
+            if st.session_state.rank_dirty:
+                st.session_state.rank_cached = pd.DataFrame(st.session_state.nick_counter.most_common(),
+                                                            columns=["昵称", "打卡次数"])
+                st.session_state.rank_dirty = False
+            rank = st.session_state.rank_cached
         
-        col_a, col_b = st.columns(2)
-        with col_a:
-            st.write("📊 累计打卡次数榜")
-            st.dataframe(rank, use_container_width=True)
+            col_a, col_b = st.columns(2)
+            with col_a:
+                st.write("📊 累计打卡次数榜")
+                st.dataframe(rank, use_container_width=True)
             
-            # 简单图表
-            st.bar_chart(rank.set_index("昵称")["打卡次数"])
+                # 简单图表
+                st.bar_chart(rank.set_index("昵称")["打卡次数"])
         
-        with col_b:
-            # 按日期筛选
-            st.write("📅 按日期查看")
-            date_options = valid_df["打卡日期"].unique()
-            selected_date = st.selectbox("选择日期", sorted(date_options, reverse=True))
-            daily_df = valid_df[valid_df["打卡日期"] == selected_date]
-            daily_rank = daily_df.groupby("昵称").size().reset_index(name="当日打卡次数")
-            daily_rank = daily_rank.sort_values("当日打卡次数", ascending=False)
-            st.dataframe(daily_rank, use_container_width=True)
+            with col_b:
+                # 按日期筛选
+                st.write("📅 按日期查看")
+                date_options = st.session_state.daily_counter.keys()
+                selected_date = st.selectbox("选择日期", sorted(date_options, reverse=True))
+                daily_rank = pd.DataFrame(st.session_state.daily_counter[selected_date].most_common(),
+                                          columns=["昵称", "当日打卡次数"])
+                st.dataframe(daily_rank, use_container_width=True)
+        else:
+            st.info("暂无有效打卡记录")
     else:
-        st.info("暂无有效打卡记录")
-else:
-    st.info("暂无打卡记录，请上传截图")
+        st.info("暂无打卡记录，请上传截图")
+
+render_leaderboard()
 
 # ------------------------------
 # 13. 管理员工具（摘要录入提醒、导出记录）
@@ -316,13 +594,29 @@ with st.expander("🔧 管理员工具"):
     if st.button("清空当前所有记录（慎用）"):
         st.session_state.records = []
         st.session_state.pending_review = []
+        st.session_state.nick_counter = Counter()
+        st.session_state.daily_counter = defaultdict(Counter)
+        st.session_state.processed = set()
+        st.session_state.no_abstract_hashes = set()
+        st.session_state.rank_dirty = True
+        # 换一个控件 key 清空已上传的文件，否则重跑时会把它们重新核验、重新记录
+        st.session_state.uploader_key += 1
         st.success("已清空")
-        st.experimental_rerun()
+        st.rerun()
     
     # 导出为CSV
     if st.session_state.records:
-        export_df = pd.DataFrame(st.session_state.records)
+        export_df = records_frame(st.session_state.records)
         csv = export_df.to_csv(index=False).encode('utf-8-sig')
         st.download_button("📥 导出全部记录为CSV", csv, "punch_records.csv", "text/csv")
     
+    # 飞书数据有缓存，管理员补录摘要/成员后可手动刷新
+    if st.button("重新拉取飞书摘要与成员列表"):
+        fetch_today_abstract.clear()
+        fetch_member_nicknames.clear()
+        # 摘要补录前核验过的图片可重新上传核验
+        st.session_state.processed -= st.session_state.no_abstract_hashes
+        st.session_state.no_abstract_hashes = set()
+        st.success("已刷新")
+    
     st.caption("💡 每日请确保飞书多维表格中已录入当天论文摘要，系统会自动拉取。")